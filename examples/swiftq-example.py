@@ -60,6 +60,7 @@ class SwiftEmailViewer(object):
     def __init__(self, config_section):
         self.conn = self.get_connection(config_section)
         self.container = config_section['container']
+        self.config = config_section
 
     def get_connection(self, config):
         timeout = (int(config['timeout']) if config.get('timeout') else None)
@@ -121,11 +122,33 @@ class SwiftEmailViewer(object):
         #print(obj_contents)
         return obj_contents  # bytes()
 
+    def _get_retention(self, path):
+        # The expiry configured for the subdir (for example
+        # retention_done = 2592000). Swift deletes expired objects by
+        # itself, so no job is needed to clean up old messages.
+        subdir = path.split('/', 1)[0]
+        return self.config.get('retention_{}'.format(subdir))
+
     def _rename(self, path, newpath):
+        retention = self._get_retention(newpath)
+        headers = {}
+        if retention:
+            headers['X-Delete-After'] = str(int(retention))
         ret = self.conn.copy_object(
             self.container, path, destination='/{}/{}'.format(
-                self.container, newpath))
+                self.container, newpath),
+            headers=headers)
         assert ret is None, ret
+        if not retention and any(
+                option.startswith('retention_') and value
+                for option, value in self.config.items()):
+            # The copy inherits the X-Delete-At of the source (e.g. from
+            # retention_cur); without a retention for the target, keep it
+            # forever. (A POST replaces X-Object-Meta-*, but swiftdrop
+            # does not set any.)
+            ret = self.conn.post_object(
+                self.container, newpath, {'X-Remove-Delete-At': '1'})
+            assert ret is None, ret
         ret = self.conn.delete_object(self.container, path)
         assert ret is None, ret
 
@@ -16,22 +16,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from configparser import ConfigParser
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from hashlib import sha256
+from itertools import count
 from logging.handlers import SysLogHandler
 from os import getpid
+from random import random
 from swiftclient import Connection
 from swiftclient.exceptions import ClientException
-from time import time
+from time import monotonic, time
+import cProfile
+import json
 import logging
 import logging.handlers
+import mailbox
 import os.path
+import pstats
+import queue
 import select
 import signal
 import socket
 import sys
+import threading
 
 # Set up logging (no datetime, this is handled by docker/k8s).
 log = logging.getLogger(__name__)
+# Wire-level (per-chunk) tracing; only used for sessions selected for
+# tracing. Its level is independent of the configured log_level.
+trace_log = logging.getLogger(__name__ + '.trace')
 
 
 class SmtpProxyMaster:
@@ -58,14 +73,58 @@ class SmtpProxyMaster:
                 conn.close()
             else:
                 # Handle the connection.
+                status = 1
                 try:
                     log.info('Handling %r', address)
                     handler = self.handler_factory(conn)
                     handler.handle()
+                    status = 0
                 except Exception:
                     log.exception('During handling of %r', address)
-                    os._exit(1)
-                os._exit(0)
+                finally:
+                    # os._exit() skips atexit; flush the queued log
+                    # records, but never let that keep us from exiting.
+                    try:
+                        _flush_logging(log)
+                    except Exception:
+                        pass
+                    os._exit(status)
+
+
+class SessionTimer(object):
+    """
+    Record monotonic timestamps of the phases of a session, to be logged
+    as a single summary line at the end.
+
+    If not enabled, mark() does nothing.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = monotonic()
+        self.marks = []
+
+    def mark(self, phase):
+        if self.enabled:
+            # (list.append is thread safe; uploads may run in threads.)
+            self.marks.append((phase, monotonic()))
+
+    def summary(self, **fields):
+        """
+        Return "key=value ..." with the fields, the total time and the
+        time (in ms since start) of every phase. Repeated phases get a
+        .N suffix.
+        """
+        parts = ['{}={}'.format(key, value) for key, value in fields.items()]
+        parts.append('total_ms={:.1f}'.format(
+            (monotonic() - self.start) * 1000))
+        seen = {}
+        for phase, timestamp in self.marks:
+            seen[phase] = seen.get(phase, 0) + 1
+            if seen[phase] > 1:
+                phase = '{}.{}'.format(phase, seen[phase])
+            parts.append('{}={:.1f}'.format(
+                phase, (timestamp - self.start) * 1000))
+        return ' '.join(parts)
 
 
 class SmtpProxyHackToGetData(object):
@@ -83,26 +142,91 @@ class SmtpProxyHackToGetData(object):
             any in this list, they will all get forwarded, as we do not
             edit RCPT TO. The (already) handled ones are discard by
             postfix later on.)
+        trace_sample_rate[float]: Fraction (0.0 .. 1.0) of sessions for
+            which the wire-level conversation is logged.
+        trace_clients[set]: Client IPs (as seen in XFORWARD ADDR=) for
+            which the wire-level conversation is always logged.
+        session_timing[bool]: Log a summary line with the timing of
+            each phase of the session.
+        profile_sample_rate[float]: Fraction (0.0 .. 1.0) of sessions
+            to run cProfile on.
+        profile_dir[str]: Directory to write the cProfile stats to.
     """
-    def __init__(self, in_, handle_recipients):
+    def __init__(self, in_, handle_recipients, trace_sample_rate=0.0,
+                 trace_clients=(), session_timing=False,
+                 profile_sample_rate=0.0, profile_dir=None):
         """
         Connect to downstream so we can use their communicating skills.
         """
+        self.timer = SessionTimer(session_timing)
+        self.timer.mark('accept')
         self.in_ = in_
         self.handle_recipients = set(i.lower() for i in handle_recipients)
+        self.client_addr = None
+        self.trace_clients = set(trace_clients)
+        self.trace = bool(trace_sample_rate) and random() < trace_sample_rate
+        self.profile_path = None
+        self.profiles = []
+        if profile_dir and profile_sample_rate and (
+                random() < profile_sample_rate):
+            self.profile_path = os.path.join(
+                profile_dir, 'swiftdrop-{:.0f}-{}.prof'.format(
+                    time(), getpid()))
         self.out = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.out.connect(('127.0.0.1', 10026))
+        self.timer.mark('connect')
+
+    def _trace(self, msg, *args):
+        """
+        Log wire-level data, but only if this session is being traced.
+
+        The arguments are not formatted here; that is left to the
+        (queued) log handler, so the relay path only pays for the
+        boolean check.
+        """
+        if self.trace:
+            trace_log.debug(msg, *args, stacklevel=2)
+
+    def _check_xforward(self, data):
+        """
+        Take the client address from XFORWARD, and enable tracing if this
+        is a client of interest.
+
+        Anything sent before the XFORWARD (banner, EHLO) is not traced.
+        """
+        for item in data.split():
+            if item.startswith(b'ADDR='):
+                self.client_addr = item[5:].decode('ascii', 'replace')
+                if not self.trace and self.client_addr in self.trace_clients:
+                    self.trace = True
+                    self._trace('[setup] tracing client %s', self.client_addr)
+                break
 
     def on_data(self, message, recipients):
         raise NotImplementedError()
 
+    def on_close(self):
+        """
+        Called after the connections are closed, before the timing summary.
+        """
+        pass
+
     def handle(self):
+        profiler = None
+        if self.profile_path:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        status = 'error'
         try:
             recipients, message = self.collect_email()
             if recipients:
                 self.on_data(message, recipients=recipients)
             self.report_success()
+            status = 'ok'
         finally:
+            if profiler:
+                profiler.disable()
             for commands in (
                 # (self.in_.shutdown, socket.SHUT_RDWR),
                 (self.in_.close,),
@@ -112,7 +236,28 @@ class SmtpProxyHackToGetData(object):
                 try:
                     commands[0](*commands[1:])
                 except Exception as e:
-                    log.info('During handling of %r', commands, exception=e)
+                    log.info('During handling of %r: %s', commands, e)
+            self.on_close()
+            if profiler:
+                self.dump_profile(profiler)
+            if self.timer.enabled:
+                log.info('[timing] %s', self.timer.summary(
+                    status=status, client=self.client_addr,
+                    profile=self.profile_path))
+
+    def dump_profile(self, profiler):
+        """
+        Write the stats of the session, merged with those of other threads
+        that worked for it (appended to self.profiles).
+        """
+        try:
+            stats = pstats.Stats(profiler)
+            for thread_profiler in self.profiles:
+                stats.add(thread_profiler)
+            stats.dump_stats(self.profile_path)
+        except OSError as e:
+            log.warning('Could not write profile: %s', e)
+            self.profile_path = None
 
     def collect_email(self):
         """
@@ -166,6 +311,7 @@ class SmtpProxyHackToGetData(object):
         bufsiz = 32767
         who = (self.in_, self.out)
         all_recipients = []
+        verb = 'banner'
 
         # Talk to other MX and relay all messages, but wait before
         # forwarding DATA.
@@ -181,7 +327,15 @@ class SmtpProxyHackToGetData(object):
                 data = self.in_.recv(bufsiz)
                 if not data:
                     raise StopIteration('in_ disconnected')
-                log.debug('[setup] >-- (%d bytes) %.64r...', len(data), data)
+                self._trace(
+                    '[setup] >-- (%d bytes) %.64r...', len(data), data)
+                if self.timer.enabled:
+                    verb = data.split(b' ', 1)[0].strip()[:16].decode(
+                        'ascii', 'replace').lower()
+                    self.timer.mark(verb)
+
+                if data.startswith(b'XFORWARD '):
+                    self._check_xforward(data)
 
                 # Technically, this could be split over multiple
                 # recv()s, but should never happen in practice. (Same
@@ -206,12 +360,13 @@ class SmtpProxyHackToGetData(object):
                     if pass_recipients:
                         # We must forward it into postfix, regardless of
                         # whether we handle any as well.
-                        log.debug(
+                        self._trace(
                             '[setup] --> (%d bytes) %.64r...', len(data), data)
                         self.out.send(data)
                         data = self.out.recv(bufsiz)
-                        log.debug(
+                        self._trace(
                             '[setup] <<< (%d bytes) %.64r...', len(data), data)
+                        self.timer.mark('data_reply')
                         self.in_.send(data)
                         skip_forward = False
                     else:
@@ -224,36 +379,42 @@ class SmtpProxyHackToGetData(object):
                         log.debug('[setup] --> RSET')
                         self.out.send(b'RSET\r\n')
                         self.out.recv(bufsiz)
+                        self.timer.mark('rset_reply')
                         skip_forward = True
 
                     # Done with setup. Return recipients.
                     return skip_forward, handle_recipients, pass_recipients
 
-                log.debug('[setup] --> (%d bytes) %.64r...', len(data), data)
+                self._trace(
+                    '[setup] --> (%d bytes) %.64r...', len(data), data)
                 self.out.send(data)
 
             if self.out in rlist:
                 data = self.out.recv(bufsiz)
                 if not data:
                     raise StopIteration('out disconnected')
-                log.debug('[setup] <<< (%d bytes) %.64r...', len(data), data)
+                self._trace(
+                    '[setup] <<< (%d bytes) %.64r...', len(data), data)
+                self.timer.mark('{}_reply'.format(verb))
                 self.in_.send(data)
 
     def _collect_email_data(self, skip_forward):
         bufsiz = 32767
 
         # Fetch data.
+        self.timer.mark('data_start')
         databuf = []
         while True:
             data = self.in_.recv(bufsiz)
             if not data:
                 raise StopIteration('in_ disconnected')
-            log.debug('[data] --> (%d bytes) %.64r...', len(data), data)
+            self._trace('[data] --> (%d bytes) %.64r...', len(data), data)
 
             databuf.append(data)
             last_bytes = self.get_last_bytes(databuf, 5)
             if last_bytes == b'\r\n.\r\n':
                 break
+        self.timer.mark('data_end')
 
         # Send data on.
         if not skip_forward:
@@ -267,6 +428,7 @@ class SmtpProxyHackToGetData(object):
                     data))
             self.out.send(b'QUIT\r\n')
             self.out.recv(bufsiz)
+            self.timer.mark('forward_end')
 
         # Return data.
         return b''.join(databuf)[0:-3]  # drop trailing ".\r\n"
@@ -280,6 +442,7 @@ class SmtpProxyHackToGetData(object):
         self.in_.send(b'250 2.0.0 Ok: queued by swiftdrop\r\n')
         data = self.in_.recv(bufsiz)
         assert data == b'QUIT\r\n'
+        self.timer.mark('quit')
         self.in_.send(b'221 2.0.0 Bye\r\n')
         try:
             data = self.in_.recv(bufsiz)
@@ -303,12 +466,93 @@ class SmtpProxyHackToGetData(object):
         return last_bytes[-count:]
 
 
+class SwiftTokenCache(object):
+    """
+    File with the storage URL and token per set of credentials, so
+    processes started later can skip authentication.
+
+    It is written by the connection test (at container start) and read
+    by the proxy. Entries older than ttl seconds are ignored. A token
+    that was revoked anyway makes swiftclient authenticate again.
+    """
+    CREDENTIALS = ('auth_version', 'authurl', 'user', 'key', 'tenant_name')
+
+    def __init__(self, path, ttl=3000):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        try:
+            with open(path, 'r') as fp:
+                self.entries = json.load(fp)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning('Ignoring bad token cache %s: %s', path, e)
+
+    @classmethod
+    def key(cls, config):
+        credentials = sorted(
+            (option, value) for option, value in config.items()
+            if option in cls.CREDENTIALS or option.startswith('os_options_'))
+        return sha256(json.dumps(credentials).encode('utf-8')).hexdigest()
+
+    def get(self, config):
+        entry = self.entries.get(self.key(config))
+        if entry and time() - entry['time'] < self.ttl:
+            return entry['url'], entry['token']
+        return None, None
+
+    def set(self, config, url, token):
+        self.entries[self.key(config)] = {
+            'url': url, 'token': token, 'time': time()}
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp, self.path)
+
+
 class SwiftEmailUploader(object):
-    def __init__(self, config):
+    """
+    Upload messages to the Swift container(s) of their destination(s).
+
+    Per section, upload_mode selects how the upload is done:
+    - primary (default): upload to the configured cluster only;
+    - hedge: also upload to the secondary cluster if the primary has
+      not finished within hedge_after seconds (or failed); accept
+      whichever finishes first;
+    - replicate: upload to both clusters concurrently; accept once
+      replicate_quorum (default 2) uploads have finished.
+    The secondary cluster is configured with secondary_<option> (e.g.
+    secondary_authurl), falling back to the primary <option>.
+
+    Uploads that are still running when the message is accepted are
+    completed (and logged) in wait_for_pending().
+
+    If a token_cache is passed, cached tokens are used instead of
+    authenticating for every connection.
+    """
+    UPLOAD_MODES = ('primary', 'hedge', 'replicate')
+
+    def __init__(self, config, token_cache=None, workers=4):
         self.config = config
+        self.token_cache = token_cache
+        self.workers = workers
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.leftovers = []
+        self.local = threading.local()
+        self.timer = SessionTimer()
+        # If a list, uploads in executor threads are profiled into it.
+        self.profiles = None
 
     def get_connection(self, config):
         timeout = (int(config['timeout']) if config.get('timeout') else None)
+        preauthurl, preauthtoken = (
+            self.token_cache.get(config) if self.token_cache
+            else (None, None))
 
         if config['auth_version'] == '3':
             # Keystone v3
@@ -321,21 +565,52 @@ class SwiftEmailUploader(object):
             connection = Connection(
                 auth_version='3', authurl=config['authurl'],
                 user=config['user'], key=config['key'],
-                os_options=os_options, timeout=timeout)
+                os_options=os_options, timeout=timeout,
+                preauthurl=preauthurl, preauthtoken=preauthtoken)
 
         elif config['auth_version'] == '1':
             # Legacy auth
             connection = Connection(
                 auth_version='1', authurl=config['authurl'],
                 user=config['user'], key=config['key'],
-                tenant_name=config['tenant_name'], timeout=timeout)
+                tenant_name=config['tenant_name'], timeout=timeout,
+                preauthurl=preauthurl, preauthtoken=preauthtoken)
 
         else:
             raise NotImplementedError('auth_version? {!r}'.format(config))
 
         return connection
 
-    def generate_filename(self, message):
+    def get_thread_connection(self, name, config):
+        # Connection is not thread safe; keep one per thread (and set of
+        # credentials), so the token and HTTP connection are reused.
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        key = (name, SwiftTokenCache.key(config))
+        if key not in connections:
+            connection = self.get_connection(config)
+            if self.timer.enabled:
+                self._mark_auth(connection, name)
+            connections[key] = connection
+        return connections[key]
+
+    def _mark_auth(self, connection, name):
+        """
+        Mark the end of the auth that swiftclient does by itself (inside
+        its retry loop), without changing how or when it is done.
+        """
+        get_auth = connection.get_auth
+
+        def timed_get_auth():
+            try:
+                return get_auth()
+            finally:
+                self.timer.mark('auth_{}'.format(name))
+
+        connection.get_auth = timed_get_auth
+
+    def generate_filename(self, message, delivery=None):
         """
         Technical operation
 
@@ -351,6 +626,9 @@ class SwiftEmailUploader(object):
         * Mn, where n is (in decimal) the microsecond counter from the
           same gettimeofday() used for the left part of the unique name.
         * Pn, where n is (in decimal) the process ID.
+        * Qn, where n is the number of deliveries made by this process.
+          [Only added if delivery is passed, as the proxy does a single
+          delivery per process.]
         * ,S=<size>: <size> contains the file size. Getting the size from
           the filename avoids doing a stat(), which may improve the
           performance. This is especially useful with Maildir++ quota.
@@ -379,13 +657,32 @@ class SwiftEmailUploader(object):
         sec, usec = [int(i) for i in str(time()).split('.')]
         size = len(message)
         flags = ''  # ':2,S'
-        filename = 'cur/{sec}.M{usec}P{pid}.{hostname},S={size}{flags}'.format(
-            sec=sec, usec=usec, pid=getpid(), hostname=socket.gethostname(),
-            size=size, flags=flags)
+        delivery = '' if delivery is None else 'Q{}'.format(delivery)
+        filename = (
+            'cur/{sec}.M{usec}P{pid}{delivery}.{hostname},S={size}{flags}'
+            .format(
+                sec=sec, usec=usec, pid=getpid(), delivery=delivery,
+                hostname=socket.gethostname(), size=size, flags=flags))
         return filename
 
+    def put_message(self, connection, config, filename, message):
+        # Let the Swift object expirer clean up old messages, instead of
+        # having a separate job list and delete them.
+        headers = {}
+        if config.get('retention_cur'):
+            headers['X-Delete-After'] = str(int(config['retention_cur']))
+
+        # connection.put_container(config['container'])
+        connection.put_object(
+            config['container'], filename, message, headers=headers,
+            content_type='text/plain')  # 'message/rfc822' raises 502s!?
+        # .. with swift 2.22, we're seeing 502s by the nginx proxy
+        # because the backend apparently disconnects if we use
+        # message/rfc822. This is unexplained thusfar.
+
     def upload(self, recipients, message):
         unique_destinations = self.recipients_to_destinations(recipients)
+        self.timer.mark('upload_start')
 
         for destination in unique_destinations:
             config = self.config[destination]
@@ -395,43 +692,232 @@ class SwiftEmailUploader(object):
                 '[swift] Uploading (%d bytes) to %s %s: %s',
                 len(message), destination, config['container'],
                 filename)
-            connection = self.get_connection(config)
-            # connection.put_container(config['container'])
-            connection.put_object(
-                config['container'], filename, message,
-                content_type='text/plain')  # 'message/rfc822' raises 502s!?
-            # .. with swift 2.22, we're seeing 502s by the nginx proxy
-            # because the backend apparently disconnects if we use
-            # message/rfc822. This is unexplained thusfar.
+            clusters = self.upload_to(destination, filename, message)
+            log.info(
+                '[swift] Uploaded to %s: %s cluster=%s',
+                destination, filename, ','.join(clusters))
 
+        self.timer.mark('upload_end')
         log.info('[swift] All uploads done')
 
-    def test_connect(self, recipients):
-        unique_destinations = self.recipients_to_destinations(recipients)
+    def upload_to(self, destination, filename, message):
+        """
+        Upload to a single destination, according to its upload_mode.
+        Returns the names of the clusters that have stored the message.
+        """
+        config = self.config[destination]
+        upload_mode = config.get('upload_mode') or 'primary'
+        if upload_mode == 'primary':
+            return [self._put('primary', config, filename, message)]
+        elif upload_mode == 'hedge':
+            return self.upload_hedged(
+                self.get_clusters(config), filename, message,
+                float(config.get('hedge_after') or 1))
+        elif upload_mode == 'replicate':
+            return self.upload_replicated(
+                self.get_clusters(config), filename, message,
+                int(config.get('replicate_quorum') or 2))
+        raise NotImplementedError('upload_mode? {!r}'.format(upload_mode))
+
+    def get_clusters(self, config):
+        """
+        Return the (name, config) of the primary and secondary cluster.
+        """
+        secondary = dict(config.items())
+        for option, value in config.items():
+            if option.startswith('secondary_'):
+                secondary[option[len('secondary_'):]] = value
+        if not config.get('secondary_authurl'):
+            raise ValueError('upload_mode {} without secondary_authurl'.format(
+                config.get('upload_mode')))
+        return [('primary', config), ('secondary', secondary)]
+
+    def upload_hedged(self, clusters, filename, message, hedge_after):
+        (primary, primary_config), (secondary, secondary_config) = clusters
+        futures = [self.submit(primary, primary_config, filename, message)]
+
+        done, not_done = wait(futures, timeout=hedge_after)
+        if done and not futures[0].exception():
+            return [futures[0].result()]
+
+        log.info(
+            '[swift] Hedging to %s cluster, %s %s', secondary, primary,
+            ('failed' if done else
+             'not done after {:.3f}s'.format(hedge_after)))
+        futures.append(
+            self.submit(secondary, secondary_config, filename, message))
+        return self.wait_for_quorum(futures, 1, filename)
+
+    def upload_replicated(self, clusters, filename, message, quorum):
+        if not 1 <= quorum <= len(clusters):
+            raise ValueError('replicate_quorum? {!r}'.format(quorum))
+        futures = [
+            self.submit(name, config, filename, message)
+            for name, config in clusters]
+        return self.wait_for_quorum(futures, quorum, filename)
+
+    def wait_for_quorum(self, futures, quorum, filename):
+        """
+        Wait until quorum uploads have succeeded; return their clusters.
+
+        Raises the last error if the quorum can no longer be reached.
+        Uploads still running are left to wait_for_pending().
+        """
+        pending = set(futures)
+        clusters = []
         failures = 0
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        clusters.append(future.result())
+                    except Exception as e:
+                        error = e  # (already logged by _put)
+                        failures += 1
+                if len(clusters) >= quorum:
+                    return clusters
+                if len(futures) - failures < quorum:
+                    break
+            raise error
+        finally:
+            with self.executor_lock:
+                self.leftovers.extend(
+                    (future, filename) for future in pending)
+
+    def submit(self, name, config, filename, message):
+        put = self._put if self.profiles is None else self._profiled_put
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers)
+            return self.executor.submit(put, name, config, filename, message)
+
+    def _profiled_put(self, *args):
+        # cProfile only sees the thread it is enabled in; profile the
+        # executor threads separately, to be merged by the handler.
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return self._put(*args)
+        finally:
+            profiler.disable()
+            self.profiles.append(profiler)
 
-        for destination in unique_destinations:
-            config = self.config[destination]
-            connection = self.get_connection(config)
-            # connection.put_container(config['container'])
-            try:
-                resp_headers, containers = connection.get_account()
-            except ClientException as e:
-                log.error(
-                    '[swift] Connection to %s FAILED: %s', destination,
-                    e)
-                failures += 1
-            else:
-                if config['container'] not in [i['name'] for i in containers]:
-                    raise ValueError('missing container {} for {}'.format(
-                        config['container'], destination))
+    def wait_for_pending(self):
+        """
+        Let uploads that were not needed for acceptance run to completion.
+        """
+        with self.executor_lock:
+            executor, self.executor = self.executor, None
+            leftovers, self.leftovers = self.leftovers, []
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+        for future, filename in leftovers:
+            # Failures have been logged by _put already.
+            if not future.exception():
                 log.info(
-                    '[swift] Connection to %s OK: %s', destination,
-                    config['container'])
+                    '[swift] Late upload done: %s cluster=%s',
+                    filename, future.result())
 
-        if failures:
+    def _put(self, name, config, filename, message):
+        start = monotonic()
+        try:
+            connection = self.get_thread_connection(name, config)
+            self.put_message(connection, config, filename, message)
+            self.timer.mark('put_{}'.format(name))
+        except Exception as e:
+            self.timer.mark('fail_{}'.format(name))
+            log.warning(
+                '[swift] Upload of %s to %s cluster FAILED after %.3fs: %s',
+                filename, name, monotonic() - start, e)
+            raise
+        log.debug(
+            '[swift] Upload of %s to %s cluster done in %.3fs',
+            filename, name, monotonic() - start)
+        return name
+
+    def test_connect(self, recipients, token_cache=None):
+        """
+        Check that we can authenticate and that the containers exist.
+
+        Destinations (and secondary clusters) that share credentials are
+        authenticated once; the credential sets are checked concurrently.
+        Validated tokens are stored in token_cache, if passed.
+        """
+        unique_destinations = self.recipients_to_destinations(recipients)
+
+        groups = {}
+        for destination in sorted(unique_destinations):
+            config = self.config[destination]
+            clusters = [('primary', config)]
+            if (config.get('upload_mode') or 'primary') != 'primary':
+                clusters = self.get_clusters(config)
+            for name, cluster_config in clusters:
+                label = (
+                    destination if name == 'primary'
+                    else '{} ({})'.format(destination, name))
+                key = SwiftTokenCache.key(cluster_config)
+                groups.setdefault(key, []).append((label, cluster_config))
+
+        with ThreadPoolExecutor(len(groups) or 1) as executor:
+            results = list(executor.map(
+                self._test_connect_credentials, groups.values()))
+
+        if token_cache:
+            for config, url, token in results:
+                if token:
+                    token_cache.set(config, url, token)
+            token_cache.save()
+
+        if not all(token for config, url, token in results):
             sys.exit(1)
 
+    def _test_connect_credentials(self, destinations):
+        """
+        Authenticate once for destinations sharing credentials and HEAD
+        their containers. Returns (config, url, token); the token is None
+        on any failure.
+
+        The auth is done by the first head_container(), so it gets the
+        retries of swiftclient.
+        """
+        credentials = destinations[0][1]
+        failures = 0
+        try:
+            connection = self.get_connection(credentials)
+            for destination, config in destinations:
+                # connection.put_container(config['container'])
+                try:
+                    connection.head_container(config['container'])
+                except ClientException as e:
+                    if e.http_status == 404:
+                        log.error(
+                            '[swift] Connection to %s FAILED: missing '
+                            'container %s', destination, config['container'])
+                    else:
+                        log.error(
+                            '[swift] Connection to %s FAILED: %s',
+                            destination, e)
+                    failures += 1
+                    if not connection.token:
+                        # Auth failed; no use trying the others.
+                        failures = len(destinations)
+                        break
+                else:
+                    log.info(
+                        '[swift] Connection to %s OK: %s', destination,
+                        config['container'])
+        except Exception as e:
+            log.error(
+                '[swift] Connection to %s FAILED: %s',
+                ', '.join(label for label, config in destinations), e)
+            return credentials, None, None
+
+        if failures:
+            return credentials, None, None
+        return credentials, connection.url, connection.token
+
     def recipients_to_destinations(self, recipients):
         destinations = set()
         for recipient in recipients:
@@ -444,11 +930,295 @@ class SwiftEmailUploader(object):
                 assert False, '{} not found in recipients'.format(recipient)
         return destinations
 
+    def get_handle_recipients(self):
+        """
+        Return the recipients of all sections: the ones we handle.
+        """
+        handle_recipients = set()
+        for section in self.config:
+            srecipients = self.config[section].get('recipients').split(',')
+            handle_recipients.update(srecipients)
+        return handle_recipients
+
+
+class SwiftEmailImporter(object):
+    """
+    Bulk upload of saved messages (a Maildir++ tree or an mbox file) to
+    Swift, for instance after an outage or a migration.
+
+    Messages are read sequentially and uploaded by a pool of worker
+    threads, using the upload_mode of the destination. Connections are
+    kept per thread, so the auth token and the HTTP connection are
+    reused.
+
+    Args:
+        uploader[SwiftEmailUploader]: Used for config, routing and naming
+        recipients[list]: Recipients to use for every message; if empty,
+            they are taken from the Delivered-To, X-Original-To, To and
+            Cc headers (only the ones we handle)
+        jobs[int]: Number of concurrent uploads
+        checkpoint[str]: File to record imported messages (and, per
+            message, the destinations done) in; these are skipped,
+            making the import resumable
+    """
+    HEADERS = ('delivered-to', 'x-original-to', 'to', 'cc')
+    PROGRESS_INTERVAL = 10  # seconds
+
+    def __init__(self, uploader, recipients=(), jobs=8, checkpoint=None):
+        self.uploader = uploader
+        self.jobs = jobs
+        self.checkpoint = checkpoint
+
+        self.handle_recipients = uploader.get_handle_recipients()
+
+        self.recipients = [i.lower() for i in recipients]
+        unknown = set(self.recipients) - self.handle_recipients
+        if unknown:
+            raise ValueError('{} not found in recipients'.format(
+                ', '.join(sorted(unknown))))
+
+        self.deliveries = count()
+        self.lock = threading.Lock()
+        self.done_destinations = set()
+        self.checkpoint_fp = None
+
+        self.imported = self.skipped = self.failed = self.bytes = 0
+
+    def get_recipients(self, message):
+        if self.recipients:
+            return self.recipients
+
+        headers = BytesHeaderParser().parsebytes(message)
+        values = []
+        for header in self.HEADERS:
+            values.extend(headers.get_all(header, []))
+        recipients = set(
+            address.lower() for name, address in getaddresses(values))
+        return sorted(recipients & self.handle_recipients)
+
+    def import_one(self, key, message):
+        recipients = self.get_recipients(message)
+        if not recipients:
+            return False
+
+        unique_destinations = self.uploader.recipients_to_destinations(
+            recipients)
+        for destination in unique_destinations:
+            if (key, destination) in self.done_destinations:
+                continue
+            filename = self.uploader.generate_filename(
+                message, delivery=next(self.deliveries))
+            self.uploader.upload_to(destination, filename, message)
+            # Record it now, so a failure for another destination does
+            # not get this one uploaded again on resume.
+            self.write_checkpoint(key, destination)
+        return True
+
+    def open_mailboxes(self, source):
+        """
+        Return (prefix, mailbox) for the mbox, or for the Maildir and
+        each of its Maildir++ folders (.Sent, .Archive.2019, ...).
+        """
+        if os.path.isdir(source):
+            root = mailbox.Maildir(source, factory=None, create=False)
+            return [('', root)] + [
+                ('{}/'.format(folder), root.get_folder(folder))
+                for folder in sorted(root.list_folders())]
+        if os.path.isfile(source):
+            return [('', mailbox.mbox(source, create=False))]
+        raise ValueError('{} is not a Maildir or mbox'.format(source))
+
+    def load_checkpoint(self):
+        """
+        Return the done keys; store the done (key, destination) pairs.
+        """
+        done = set()
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return done
+        with open(self.checkpoint, 'r') as fp:
+            for line in fp:
+                key, sep, destination = line.rstrip('\n').partition('\t')
+                if sep:
+                    self.done_destinations.add((key, destination))
+                else:
+                    done.add(key)
+        return done
+
+    def write_checkpoint(self, key, destination=None):
+        if self.checkpoint_fp:
+            with self.lock:
+                if destination is None:
+                    self.checkpoint_fp.write('{}\n'.format(key))
+                else:
+                    self.checkpoint_fp.write(
+                        '{}\t{}\n'.format(key, destination))
+                self.checkpoint_fp.flush()
+
+    def run(self, mailboxes):
+        """
+        Import the mailboxes, as returned by open_mailboxes().
+        """
+        done = self.load_checkpoint()
+        if done:
+            log.info('[import] Resuming, skipping %d done messages', len(done))
+
+        self.checkpoint_fp = (
+            open(self.checkpoint, 'a') if self.checkpoint else None)
+        try:
+            with ThreadPoolExecutor(self.jobs) as executor:
+                self._run(executor, mailboxes, done)
+            # Hedged/replicated uploads not needed for acceptance.
+            self.uploader.wait_for_pending()
+        finally:
+            if self.checkpoint_fp:
+                self.checkpoint_fp.close()
+                self.checkpoint_fp = None
+            for prefix, messages in mailboxes:
+                messages.close()
+
+        self.report_progress(final=True)
+        return not self.failed
+
+    def _run(self, executor, mailboxes, done):
+        self.started = self.reported = time()
+        pending = {}
+
+        for prefix, messages in mailboxes:
+            for key in messages.iterkeys():
+                name = '{}{}'.format(prefix, key)
+                if name in done:
+                    continue
+                message = messages.get_bytes(key)
+                pending[executor.submit(self.import_one, name, message)] = (
+                    name, len(message))
+
+                # Don't read ahead too far; keep memory bounded.
+                if len(pending) >= 2 * self.jobs:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self.collect(finished, pending)
+
+        self.collect(wait(pending)[0], pending)
+
+    def collect(self, finished, pending):
+        for future in finished:
+            key, size = pending.pop(future)
+            try:
+                uploaded = future.result()
+            except Exception as e:
+                log.error('[import] Message %s FAILED: %s', key, e)
+                self.failed += 1
+                continue
+
+            if uploaded:
+                self.imported += 1
+                self.bytes += size
+            else:
+                log.warning('[import] Message %s has no recipients', key)
+                self.skipped += 1
+
+            self.write_checkpoint(key)
+
+        if time() - self.reported >= self.PROGRESS_INTERVAL:
+            self.report_progress()
+
+    def report_progress(self, final=False):
+        self.reported = time()
+        elapsed = max(self.reported - self.started, 0.001)
+        log.info(
+            '[import] %s: %d imported, %d skipped, %d failed; '
+            '%.1f msg/s, %.2f MB/s',
+            'Done' if final else 'Progress',
+            self.imported, self.skipped, self.failed,
+            self.imported / elapsed, self.bytes / elapsed / 1048576)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room instead of raising queue.Full. (Only called from
+        # NonBlockingQueueHandler._stop, which has a time limit.)
+        self.queue.put(self._sentinel)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Log handler that hands records to a background thread, so the relay
+    never waits for (syslog) I/O.
+
+    If the queue is full, records are dropped instead of blocking. The
+    records are passed as-is (not pre-formatted, as the stock
+    QueueHandler does), so formatting happens in the listener thread.
+
+    The listener thread does not survive fork(); call after_fork() in
+    the child to get a fresh queue and listener.
+
+    close() waits at most STOP_TIMEOUT seconds for the queued records to
+    be written; if the target is stalled, the rest is lost.
+    """
+    STOP_TIMEOUT = 2  # seconds
+
+    def __init__(self, target, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.dropped = 0
+        self.listener = None
+        self.start()
+
+    def start(self):
+        self.listener = _QueueListener(
+            self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def after_fork(self):
+        # The parent's listener thread is gone, and the queue (and its
+        # locks) may have been copied in an inconsistent state.
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.dropped = 0
+        self.start()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            # QueueListener.stop() waits for the target without a time
+            # limit; stop from a daemon thread so we can give up on it.
+            stopper = threading.Thread(
+                target=self._stop, args=(listener,), daemon=True)
+            stopper.start()
+            stopper.join(self.STOP_TIMEOUT)
+        super().close()
+
+    def _stop(self, listener):
+        try:
+            listener.stop()
+            if self.dropped:
+                self.target.handle(logging.makeLogRecord({
+                    'name': log.name, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING', 'msg': (
+                        'Dropped %d log records (queue full)'),
+                    'args': (self.dropped,)}))
+        except Exception:
+            pass
+
 
 class SwiftEmailUploaderHandler(SmtpProxyHackToGetData):
     def __init__(self, uploader, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.uploader = uploader
+        self.uploader.timer = self.timer
+        if self.profile_path:
+            self.uploader.profiles = self.profiles
+
+    def on_close(self):
+        # The client has its answer; finish any extra uploads.
+        self.uploader.wait_for_pending()
 
     def on_data(self, message, recipients):
         if not recipients:
@@ -459,6 +1229,64 @@ class SwiftEmailUploaderHandler(SmtpProxyHackToGetData):
         self.uploader.upload(recipients, message)
 
 
+def check_config(config):
+    """
+    Check the options that are otherwise only used (and would only fail)
+    while handling a message, or at proxy startup. Raises ValueError.
+    """
+    defaults = config.defaults()
+    log_level = defaults.get('log_level')
+    if log_level and not isinstance(
+            logging.getLevelName(log_level.upper()), int):
+        raise ValueError('[DEFAULT] log_level: unknown level {!r}'.format(
+            log_level))
+    for option in ('trace_sample_rate', 'profile_sample_rate'):
+        value = defaults.get(option)
+        if value:
+            try:
+                if not 0 <= float(value) <= 1:
+                    raise ValueError()
+            except ValueError:
+                raise ValueError(
+                    '[DEFAULT] {}: expected 0.0 .. 1.0, got {!r}'.format(
+                        option, value))
+
+    for section in config:
+        for option, value in config[section].items():
+            if option.startswith('retention_') and value:
+                try:
+                    if int(value) <= 0:
+                        raise ValueError()
+                except ValueError:
+                    raise ValueError(
+                        '[{}] {}: expected seconds, got {!r}'.format(
+                            section, option, value))
+
+        options = config[section]
+        upload_mode = options.get('upload_mode') or 'primary'
+        if upload_mode not in SwiftEmailUploader.UPLOAD_MODES:
+            raise ValueError('[{}] upload_mode: expected one of {}'.format(
+                section, ', '.join(SwiftEmailUploader.UPLOAD_MODES)))
+        if upload_mode == 'primary':
+            continue
+        if not options.get('secondary_authurl'):
+            raise ValueError(
+                '[{}] upload_mode {} needs secondary_authurl'.format(
+                    section, upload_mode))
+        try:
+            if float(options.get('hedge_after') or 1) <= 0:
+                raise ValueError()
+        except ValueError:
+            raise ValueError('[{}] hedge_after: expected seconds'.format(
+                section))
+        try:
+            if int(options.get('replicate_quorum') or 2) not in (1, 2):
+                raise ValueError()
+        except ValueError:
+            raise ValueError('[{}] replicate_quorum: expected 1 or 2'.format(
+                section))
+
+
 def exit_message(message, code=1, parser=None):
     sys.stderr.write(message)
     if not message.endswith('\n'):
@@ -468,25 +1296,60 @@ def exit_message(message, code=1, parser=None):
     sys.exit(code)
 
 
-def main_proxy(config):
-    def handler_factory(*args, **kwargs):
-        uploader = SwiftEmailUploader(config)
+def get_token_cache(config):
+    defaults = config.defaults()
+    if not defaults.get('token_cache'):
+        return None
+    return SwiftTokenCache(
+        defaults['token_cache'],
+        ttl=int(defaults.get('token_cache_ttl') or 3000))
 
-        handle_recipients = set()
-        for section in config:
-            srecipients = config[section].get('recipients').split(',')
-            handle_recipients.update(srecipients)
 
+def main_proxy(config):
+    defaults = config.defaults()
+    trace_sample_rate = float(defaults.get('trace_sample_rate') or 0)
+    trace_clients = set(
+        i.strip() for i in (defaults.get('trace_clients') or '').split(',')
+        if i.strip())
+    session_timing = (defaults.get('session_timing') or '').lower() in (
+        '1', 'yes', 'true', 'on')
+    profile_sample_rate = float(defaults.get('profile_sample_rate') or 0)
+    profile_dir = defaults.get('profile_dir') or '/tmp'
+
+    # Read once; the forked handlers share it.
+    token_cache = get_token_cache(config)
+
+    def handler_factory(*args, **kwargs):
+        uploader = SwiftEmailUploader(config, token_cache=token_cache)
         return SwiftEmailUploaderHandler(
-            uploader, handle_recipients=handle_recipients, *args, **kwargs)
+            uploader, handle_recipients=uploader.get_handle_recipients(),
+            trace_sample_rate=trace_sample_rate, trace_clients=trace_clients,
+            session_timing=session_timing,
+            profile_sample_rate=profile_sample_rate, profile_dir=profile_dir,
+            *args, **kwargs)
 
     proxy = SmtpProxyMaster(handler_factory)
     proxy.run()
 
 
 def main_swift_connect_test(config, recipients):
+    # Always authenticate from scratch; only write the token cache.
     uploader = SwiftEmailUploader(config)
-    uploader.test_connect(recipients)
+    uploader.test_connect(recipients, token_cache=get_token_cache(config))
+
+
+def main_import(config, source, recipients, jobs, checkpoint):
+    uploader = SwiftEmailUploader(
+        config, token_cache=get_token_cache(config), workers=2 * jobs)
+    try:
+        importer = SwiftEmailImporter(
+            uploader, recipients=recipients, jobs=jobs,
+            checkpoint=checkpoint)
+        mailboxes = importer.open_mailboxes(source)
+    except ValueError as e:
+        exit_message('error: {}'.format(e))
+    if not importer.run(mailboxes):
+        sys.exit(1)
 
 
 def main_lda(config, recipients, message):
@@ -494,26 +1357,46 @@ def main_lda(config, recipients, message):
     uploader.upload(recipients, message)
 
 
-def _setup_syslog(log):
+def _setup_syslog(log, config):
     """
     Set up logging when running as daemon
+
+    The level is taken from log_level in the DEFAULT section (default
+    DEBUG). Wire-level tracing is logged regardless of that level, but
+    only for sessions selected through trace_sample_rate/trace_clients.
     """
-    log.setLevel(logging.DEBUG)
+    log.setLevel((config.defaults().get('log_level') or 'DEBUG').upper())
+    trace_log.setLevel(logging.DEBUG)
     try:
-        handler = SysLogHandler(
+        target = SysLogHandler(
             address='/dev/log', facility=SysLogHandler.LOG_DAEMON)
     except FileNotFoundError:
-        handler = logging.StreamHandler()
+        target = logging.StreamHandler()
     formatter = logging.Formatter(
         '[%(process)d] %(module)s.%(funcName)s: %(message)s')
-    handler.setFormatter(formatter)
+    target.setFormatter(formatter)
+    handler = NonBlockingQueueHandler(target)
+    os.register_at_fork(after_in_child=handler.after_fork)
     log.addHandler(handler)
 
 
+def _flush_logging(log):
+    """
+    Write out the queued log records before os._exit()
+
+    Not using logging.shutdown(), as that would wait (forever) for the
+    lock of a target handler that is stuck writing to a stalled syslog.
+    """
+    for handler in list(log.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            handler.close()
+
+
 def main():
-    # There are three modes of operation:
+    # There are four modes of operation:
     # - proxy-daemon-mode
     # - swift connection test
+    # - bulk import from Maildir/mbox
     # - one-shot email save (DISABLED)
     parser = ArgumentParser(
         description='Drop email to a swift server.')
@@ -526,10 +1409,22 @@ def main():
         '--test-connect', action='store_true', help='Connection test only')
     parser.add_argument(
         '--run-as-proxy', action='store_true', help='Run in proxy mode')
+    parser.add_argument(
+        '--import', metavar='DIR|MBOX', dest='import_',
+        help='Upload all messages from a Maildir or mbox')
+    parser.add_argument(
+        '--jobs', metavar='N', type=int, default=8,
+        help='Concurrent uploads in import mode')
+    parser.add_argument(
+        '--checkpoint', metavar='FILE',
+        help='Record/skip imported messages, making import resumable')
     parser.add_argument(
         'recipients', metavar='RECIPIENT', nargs='*', help=(
-            'The recipients; used for test-connect or one-shot mode only'))
+            'The recipients; used for test-connect, import or one-shot '
+            'mode only (import takes them from the headers if unset)'))
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
 
     config = ConfigParser(allow_no_value=True)
 
@@ -542,10 +1437,20 @@ def main():
         exit_message(
             'default config options written to {}'.format(args.config))
 
+    try:
+        check_config(config)
+    except ValueError as e:
+        exit_message('error: bad config: {}'.format(e))
+
     if args.run_as_proxy and not args.test_connect:
         global log
-        _setup_syslog(log)
+        _setup_syslog(log, config)
         main_proxy(config)
+    elif args.import_:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        main_import(
+            config, args.import_, args.recipients, args.jobs,
+            args.checkpoint)
     elif not args.recipients:
         exit_message('error: missing recipients', parser=parser)
     elif args.test_connect: